@@ -1,27 +1,42 @@
 import streamlit as st
 import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
+import google.oauth2.credentials
 from datetime import datetime, timedelta
 import pytz
 from math import sqrt
 import pandas as pd
+import numpy as np
+from disk_cache import get_disk_cache_path, read_disk_cache, write_disk_cache
 
 # Page config
 st.set_page_config(page_title="Supply-Demand Distribution", layout="wide")
 
-# Initialize BigQuery client
+# Initialize BigQuery clients
 @st.cache_resource
-def get_bq_client():
+def get_credentials():
     credentials_dict = st.secrets["gcp_service_account"]
-    credentials = google.oauth2.credentials.Credentials(
+    return google.oauth2.credentials.Credentials(
         None,
         refresh_token=credentials_dict['refresh_token'],
         token_uri="https://oauth2.googleapis.com/token",
         client_id=credentials_dict['client_id'],
         client_secret=credentials_dict['client_secret']
     )
-    return bigquery.Client(project='postmates-x', credentials=credentials)
+
+@st.cache_resource
+def get_bq_client():
+    client = bigquery.Client(project='postmates-x', credentials=get_credentials())
+    # Fetch the OAuth token and open the connection once per process
+    client.query('SELECT 1').result()
+    return client
+
+# Streams query results as Arrow record batches instead of paged JSON rows
+@st.cache_resource
+def get_bqstorage_client():
+    return bigquery_storage.BigQueryReadClient(credentials=get_credentials())
 
 bq = get_bq_client()
 
@@ -34,43 +49,53 @@ def get_square_bounds(lat, lon, side_length_meters):
         [lat + degree_delta, lon + degree_delta]
     ]
 
-@st.cache_data
+DISK_CACHE_TTL = 300
+
+@st.cache_data(ttl=600, max_entries=48, show_spinner='Fetching data...')
 def fetch_data(hour, day_offset):
     # Calculate the date based on the offset
     pst = pytz.timezone('America/Los_Angeles')
     current_time = datetime.now(pst)
     selected_date = current_time.date() + timedelta(days=day_offset)
+    # The 24-hour lookback ends at the next hour boundary instead of CURRENT_TIMESTAMP(),
+    # so the SQL is deterministic within an hour and BigQuery can serve cached results
+    as_of = current_time.replace(minute=0, second=0, microsecond=0) + timedelta(hours=1)
     
-    query = f"""
-    DECLARE hour INT64 DEFAULT {hour};
-    DECLARE selected_date DATE DEFAULT DATE '{selected_date}';
-    CREATE TEMP FUNCTION get_part_of_day(hour INT64) AS (hour);
-
+    query = """
     WITH hotspots AS (
       SELECT
         label,
         hotspot_location,
-        ST_X(hotspot_location) as longitude,
-        ST_Y(hotspot_location) as latitude,
-        SAFE_CAST(delivery_count AS FLOAT64) as predicted_demand
-      FROM `serve-robotics.serve_analytics.stg_delivery_platform__hotspots`
-      WHERE date = selected_date
-      AND day_of_week = LOWER(FORMAT_DATE("%A", selected_date))
-      AND part_of_day = get_part_of_day(hour)
+        longitude,
+        latitude,
+        predicted_demand
+      FROM `serve-robotics.serve_analytics.hotspots_mv`
+      WHERE date = @selected_date
+      AND day_of_week = LOWER(FORMAT_DATE("%A", @selected_date))
+      AND part_of_day = @hour
+    ),
+
+    -- Level-13 S2 cells (~1 km) covering every hotspot plus the 420m join radius,
+    -- used to discard far-away points before any distance is computed
+    hotspot_cells AS (
+      SELECT DISTINCT cell
+      FROM hotspots,
+      UNNEST(S2_COVERINGCELLIDS(hotspot_location, min_level => 13, max_level => 13, buffer => 420)) AS cell
     ),
 
     hotspot_offers AS (
       SELECT
         h.label AS hotspot_label,
-        COUNT(DISTINCT q.partner_job_id) AS num_offers
+        APPROX_COUNT_DISTINCT(q.partner_job_id) AS num_offers
       FROM hotspots h
       LEFT JOIN `serve-robotics.serve_analytics.quotes` q
-        ON ST_DISTANCE(h.hotspot_location, q.pickup_location) <= 400
+        ON ST_DWITHIN(h.hotspot_location, q.pickup_location, 400)
       WHERE q.cardio_env = 'prod'
       AND q.partner_id = 'uber_eats_api'
-      AND TIMESTAMP(q.time) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
-      AND EXTRACT(HOUR FROM q.time AT TIME ZONE "America/Los_Angeles") = hour
+      AND q.time >= TIMESTAMP_SUB(@as_of, INTERVAL 24 HOUR)
+      AND EXTRACT(HOUR FROM q.time AT TIME ZONE "America/Los_Angeles") = @hour
       AND q.partner_job_id IS NOT NULL
+      AND S2_CELLIDFROMPOINT(q.pickup_location, 13) IN (SELECT cell FROM hotspot_cells)
       GROUP BY h.label
     ),
 
@@ -83,13 +108,16 @@ def fetch_data(hour, day_offset):
         FROM `serve-robotics.serve_analytics.deliveries_wide`
         WHERE cardio_env = 'prod'
         AND partner_id = 'uber_eats_api'
-        AND TIMESTAMP(courier_dispatched_datetime_pst) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
+        AND TIMESTAMP(courier_dispatched_datetime_pst) >= TIMESTAMP_SUB(@as_of, INTERVAL 24 HOUR)
       ),
 
       filtered_rover_state AS (
-        SELECT
-          r.*,
-          dt.robot_id IS NOT NULL AS is_on_delivery
+        SELECT DISTINCT
+          r.robot_id,
+          r.time_pst,
+          dt.robot_id IS NOT NULL AS is_on_delivery,
+          r.geo_pose_longitude,
+          r.geo_pose_latitude
         FROM `serve-robotics.serve_analytics.stg_rover_state` r
         INNER JOIN `serve-robotics.serve_analytics.on_duty_intervals_ts` d
           ON r.robot_id = d.robot_id
@@ -97,30 +125,29 @@ def fetch_data(hour, day_offset):
         LEFT JOIN delivery_times dt
           ON r.robot_id = dt.robot_id
           AND TIMESTAMP(r.time_pst) BETWEEN dt.start_ts AND dt.end_ts
-        WHERE EXTRACT(HOUR FROM r.time_pst) = hour
-          AND TIMESTAMP(r.time_pst) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
-          AND r.time > CURRENT_TIMESTAMP() - INTERVAL 2 DAY
+        WHERE EXTRACT(HOUR FROM r.time_pst) = @hour
+          AND TIMESTAMP(r.time_pst) >= TIMESTAMP_SUB(@as_of, INTERVAL 24 HOUR)
+          AND r.time > TIMESTAMP_SUB(@as_of, INTERVAL 2 DAY)
           AND d.cardio_env = 'prod'
+          AND S2_CELLIDFROMPOINT(ST_GEOGPOINT(r.geo_pose_longitude, r.geo_pose_latitude), 13) IN (SELECT cell FROM hotspot_cells)
       ),
 
       point_assignments AS (
-        SELECT
+        SELECT DISTINCT
           r.robot_id,
           r.time_pst,
           r.is_on_delivery,
           TIMESTAMP_TRUNC(r.time_pst, HOUR) AS time_hour,
           h.label as location
         FROM filtered_rover_state r
-        CROSS JOIN hotspots h
-        WHERE ST_DISTANCE(h.hotspot_location, ST_GEOGPOINT(r.geo_pose_longitude, r.geo_pose_latitude)) <= 420
-        GROUP BY 1, 2, 3, 4, 5
+        JOIN hotspots h
+          ON ST_DWITHIN(h.hotspot_location, ST_GEOGPOINT(r.geo_pose_longitude, r.geo_pose_latitude), 420)
       ),
 
       bulk AS (
         SELECT
           *,
-          LEAD(time_pst) OVER (PARTITION BY robot_id ORDER BY time_pst) AS next_time_pst,
-          ROW_NUMBER() OVER (PARTITION BY robot_id, time_pst ORDER BY location) as rn
+          LEAD(time_pst) OVER (PARTITION BY robot_id ORDER BY time_pst) AS next_time_pst
         FROM point_assignments
       )
 
@@ -128,42 +155,92 @@ def fetch_data(hour, day_offset):
         location AS hotspot_label,
         is_on_delivery,
         robot_id,
-        SUM(TIMESTAMP_DIFF(next_time_pst, time_pst, SECOND) / 3600.0) AS hours,
-        COUNT(DISTINCT robot_id) AS num_robots
+        SUM(TIMESTAMP_DIFF(next_time_pst, time_pst, SECOND) / 3600.0) AS hours
       FROM bulk
       WHERE next_time_pst IS NOT NULL
       GROUP BY location, is_on_delivery, robot_id
+    ),
+
+    -- Offers and supply pre-aggregated to (hotspot_label, metric_name, value)
+    -- so hotspots is joined once below instead of once per metric CTE
+    hotspot_metrics AS (
+      SELECT hotspot_label, 'offers' AS metric_name, CAST(num_offers AS FLOAT64) AS value
+      FROM hotspot_offers
+      UNION ALL
+      SELECT hotspot_label, IF(is_on_delivery, 'on_delivery_hours', 'not_on_delivery_hours'), hours
+      FROM hotspot_supply_hours
+      UNION ALL
+      SELECT hotspot_label, 'robots', CAST(APPROX_COUNT_DISTINCT(robot_id) AS FLOAT64)
+      FROM hotspot_supply_hours
+      GROUP BY hotspot_label
+    ),
+
+    hotspot_summary AS (
+      SELECT
+        h.label AS hotspot_label,
+        h.predicted_demand,
+        h.latitude,
+        h.longitude,
+        CAST(SUM(IF(m.metric_name = 'offers', m.value, 0)) AS INT64) AS num_offers,
+        SUM(IF(m.metric_name = 'not_on_delivery_hours', m.value, 0)) AS on_duty_not_on_delivery_hours,
+        SUM(IF(m.metric_name = 'on_delivery_hours', m.value, 0)) AS on_duty_on_delivery_hours,
+        SUM(IF(m.metric_name IN ('on_delivery_hours', 'not_on_delivery_hours'), m.value, 0)) AS net_supply_hours,
+        CAST(SUM(IF(m.metric_name = 'robots', m.value, 0)) AS INT64) AS num_robots
+      FROM hotspots h
+      LEFT JOIN hotspot_metrics m
+        ON h.label = m.hotspot_label
+      GROUP BY
+        h.label,
+        h.predicted_demand,
+        h.latitude,
+        h.longitude
     )
 
     SELECT
-      h.label AS hotspot_label,
-      h.predicted_demand,
-      h.latitude,
-      h.longitude,
-      COALESCE(ho.num_offers, 0) AS num_offers,
-      COALESCE(SUM(CASE WHEN hs.is_on_delivery = FALSE THEN hs.hours END), 0) AS on_duty_not_on_delivery_hours,
-      COALESCE(SUM(CASE WHEN hs.is_on_delivery = TRUE THEN hs.hours END), 0) AS on_duty_on_delivery_hours,
-      COALESCE(SUM(hs.hours), 0) AS net_supply_hours,
-      COUNT(DISTINCT hs.robot_id) AS num_robots
-    FROM hotspots h
-    LEFT JOIN hotspot_offers ho
-      ON h.label = ho.hotspot_label
-    LEFT JOIN hotspot_supply_hours hs
-      ON h.label = hs.hotspot_label
-    GROUP BY
-      h.label,
-      h.predicted_demand,
-      h.latitude,
-      h.longitude,
-      ho.num_offers
-    ORDER BY h.predicted_demand DESC;
+      *,
+      CASE
+        WHEN predicted_demand >= 2 AND net_supply_hours <= 0.1 THEN 'High Demand No Supply'
+        WHEN predicted_demand > 0 AND net_supply_hours <= 0.1 THEN 'Demand No Supply'
+        WHEN predicted_demand > 0 AND net_supply_hours > 0.1 THEN 'Demand With Supply'
+        WHEN predicted_demand <= 0 AND net_supply_hours > 0.1 THEN 'Supply No Demand'
+        ELSE 'No Activity'
+      END AS status
+    FROM hotspot_summary
+    ORDER BY predicted_demand DESC;
     """
     
-    with st.spinner('Fetching data...'):
-        data = bq.query(query).result().to_dataframe()
-        data.loc[data['predicted_demand'] <= 0, 'predicted_demand'] = 0
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("hour", "INTEGER", hour),
+            bigquery.ScalarQueryParameter("selected_date", "DATE", selected_date),
+            bigquery.ScalarQueryParameter("as_of", "TIMESTAMP", as_of),
+        ],
+        use_query_cache=True
+    )
+
+    cache_path = get_disk_cache_path(query, job_config.query_parameters)
+    data, _ = read_disk_cache(cache_path, DISK_CACHE_TTL)
+    if data is not None:
+        return data
+
+    data = bq.query(query, job_config=job_config).result().to_dataframe(
+        bqstorage_client=get_bqstorage_client(),
+        create_bqstorage_client=False,
+        dtypes={
+            'predicted_demand': 'float32',
+            'num_offers': 'int32',
+            'net_supply_hours': 'float32',
+            'latitude': 'float32',
+            'longitude': 'float32',
+            'hotspot_label': 'category',
+            'status': 'category'
+        }
+    )
+    data.loc[data['predicted_demand'] <= 0, 'predicted_demand'] = 0
+    write_disk_cache(cache_path, data)
     return data
 
+@st.cache_data(ttl=600, show_spinner=False)
 def create_map(hour, day_offset):
     # Get data using cached function
     data = fetch_data(hour, day_offset)
@@ -177,24 +254,10 @@ def create_map(hour, day_offset):
         'No Activity': '#888888'             # Gray
     }
 
-    def get_status(row):
-        demand = row['predicted_demand']
-        supply = row['net_supply_hours']
-        has_supply = supply > 0.1
-        
-        if demand >= 2 and not has_supply:
-            return 'High Demand No Supply'
-        elif demand > 0 and not has_supply:
-            return 'Demand No Supply'
-        elif demand > 0 and has_supply:
-            if supply > 24:
-                st.warning(f"Warning: Unrealistic supply hours ({supply}) for hotspot {row['hotspot_label']}")
-            return 'Demand With Supply'
-        elif has_supply and demand <= 0:
-            return 'Supply No Demand'
-        return 'No Activity'
-    
-    data['status'] = data.apply(get_status, axis=1)
+    # Sanity check on supply hours, reported once rather than per row
+    bad = data[(data['status'] == 'Demand With Supply') & (data['net_supply_hours'] > 24)]
+    if len(bad):
+        st.warning(f"Warning: Unrealistic supply hours for hotspots {', '.join(bad['hotspot_label'].astype(str))}")
 
     # Create map
     center_lat = data['latitude'].mean()
@@ -203,26 +266,59 @@ def create_map(hour, day_offset):
                   zoom_start=13,
                   tiles='cartodbpositron')
 
-    # Add hotspot squares
-    for idx, row in data.iterrows():
-        if pd.notna(row['hotspot_label']):
-            bounds = get_square_bounds(row['latitude'], row['longitude'], 400)
-            popup_content = f"""
-            <b>Hotspot {row['hotspot_label']}</b><br>
-            Predicted Demand: {row['predicted_demand']:.2f}<br>
-            Actual Offers: {row['num_offers']}<br>
-            Supply Hours: {row['net_supply_hours']:.2f}<br>
-            Status: {row['status']}
-            """
-            folium.Rectangle(
-                bounds=bounds,
-                color='black',
-                weight=1,
-                fill=True,
-                fillColor=color_scheme[row['status']],
-                fillOpacity=0.6,
-                popup=popup_content
-            ).add_to(m)
+    # Add hotspot squares as a single GeoJSON layer
+    hotspots = data.dropna(subset=['hotspot_label'])
+    # Color by integer category code; categories follow color_scheme's order
+    status_codes = pd.Categorical(hotspots['status'], categories=list(color_scheme)).codes
+    fill_colors = np.array(list(color_scheme.values()))[status_codes]
+    (south, west), (north, east) = get_square_bounds(
+        hotspots['latitude'].to_numpy(dtype='float64'),
+        hotspots['longitude'].to_numpy(dtype='float64'),
+        400
+    )
+    features = []
+    for label, s_lat, w_lon, n_lat, e_lon, demand, offers, supply, status, fill_color in zip(
+        hotspots['hotspot_label'].to_numpy(),
+        south.tolist(),
+        west.tolist(),
+        north.tolist(),
+        east.tolist(),
+        hotspots['predicted_demand'].to_numpy(),
+        hotspots['num_offers'].to_numpy(),
+        hotspots['net_supply_hours'].to_numpy(),
+        hotspots['status'].to_numpy(),
+        fill_colors
+    ):
+        features.append({
+            'type': 'Feature',
+            'properties': {
+                'label': str(label),
+                'predicted_demand': f"{demand:.2f}",
+                'num_offers': int(offers),
+                'net_supply_hours': f"{supply:.2f}",
+                'status': status,
+                'color': str(fill_color)
+            },
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[w_lon, s_lat], [e_lon, s_lat], [e_lon, n_lat], [w_lon, n_lat], [w_lon, s_lat]]]
+            }
+        })
+
+    if features:
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            style_function=lambda feature: {
+                'color': 'black',
+                'weight': 1,
+                'fillColor': feature['properties']['color'],
+                'fillOpacity': 0.6
+            },
+            popup=folium.GeoJsonPopup(
+                fields=['label', 'predicted_demand', 'num_offers', 'net_supply_hours', 'status'],
+                aliases=['Hotspot', 'Predicted Demand', 'Actual Offers', 'Supply Hours', 'Status']
+            )
+        ).add_to(m)
 
     # Add legend directly to the map
     legend_html = """
@@ -252,7 +348,8 @@ def create_map(hour, day_offset):
     legend_html += "</div>"
     m.get_root().html.add_child(folium.Element(legend_html))
 
-    return m
+    # Return the rendered HTML so reruns with the same selection are cache hits
+    return m.get_root().render()
 
 def main():
     st.title("Hotspot Demand Map")
@@ -286,8 +383,8 @@ def main():
     st.write(f"Showing Data for: {display_time.strftime('%Y-%m-%d %H:00')} - {(display_time + timedelta(hours=1)).strftime('%H:00')}")
     
     # Create and display map
-    m = create_map(hour, day_offset)
-    st_folium(m, width=1400, height=600)
+    map_html = create_map(hour, day_offset)
+    components.html(map_html, width=1400, height=600)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -1,38 +1,62 @@
 import streamlit as st
 import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 from google.oauth2 import credentials
 import pytz
 from datetime import datetime, timedelta
 import branca.colormap as cm
 import json
-import re
 import pandas as pd
+import numpy as np
 import base64
 import io
 from folium.plugins import MarkerCluster
+import pydeck as pdk
+from disk_cache import get_disk_cache_path, read_disk_cache, write_disk_cache
 
 # Page config
 st.set_page_config(page_title="Hotspot Demand Map", layout="wide")
 
-# Initialize BigQuery client
+# Initialize BigQuery clients
+@st.cache_resource
+def get_credentials():
+    credentials_dict = st.secrets["gcp_service_account"]
+    return credentials.Credentials(
+        token=None,
+        refresh_token=credentials_dict['refresh_token'],
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=credentials_dict['client_id'],
+        client_secret=credentials_dict['client_secret']
+    )
+
 @st.cache_resource
 def get_bq_client():
     try:
-        credentials_dict = st.secrets["gcp_service_account"]
-        credentials_obj = credentials.Credentials(
-            token=None,
-            refresh_token=credentials_dict['refresh_token'],
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=credentials_dict['client_id'],
-            client_secret=credentials_dict['client_secret']
-        )
-        return bigquery.Client(project='postmates-x', credentials=credentials_obj)
+        client = bigquery.Client(project='postmates-x', credentials=get_credentials())
+        # Fetch the OAuth token and open the connection once per process
+        client.query('SELECT 1').result()
+        return client
     except Exception as e:
         st.error(f"Error initializing BigQuery client: {str(e)}")
         raise
 
+# Storage API read client, used by to_dataframe for Arrow transport
+@st.cache_resource
+def get_bqstorage_client():
+    try:
+        return bigquery_storage.BigQueryReadClient(credentials=get_credentials())
+    except Exception as e:
+        st.error(f"Error initializing BigQuery Storage client: {str(e)}")
+        raise
+
+try:
+    bq = get_bq_client()
+except Exception as e:
+    st.error("Failed to initialize application. Please check your credentials.")
+    st.stop()
+
 def download_link(df, filename, text):
     """Generate a link to download the DataFrame as CSV"""
     csv = df.to_csv(index=False)
@@ -40,16 +64,29 @@ def download_link(df, filename, text):
     href = f'<a href="data:file/csv;base64,{b64}" download="{filename}">{text}</a>'
     return href
 
-def parse_wkt_polygon(wkt_string):
-    coords_str = re.search(r'\(\((.*)\)\)', wkt_string).group(1)
-    coords_pairs = coords_str.split(',')
-    coordinates = []
-    for pair in coords_pairs:
-        lon, lat = map(float, pair.strip().split())
-        coordinates.append([lat, lon])
-    return coordinates
+# Meters from a hotspot's center to each side of its square
+HOTSPOT_BUFFER_SIZE = 325
 
-@st.cache_data
+def get_square_bounds(data):
+    # Vectorized equivalent of the square polygon formerly built in SQL
+    lats = data['latitude'].to_numpy()
+    lons = data['longitude'].to_numpy()
+    dlat = HOTSPOT_BUFFER_SIZE / 111320
+    dlon = HOTSPOT_BUFFER_SIZE / (np.cos(np.radians(lats)) * 111320)
+    return np.stack([lats - dlat, lons - dlon, lats + dlat, lons + dlon], axis=1)
+
+def get_export_data(data):
+    # CSV export keeps the square_geometry WKT column the query used to return
+    export = data.copy()
+    export.insert(2, 'square_geometry', [
+        f"POLYGON(({west} {south}, {east} {south}, {east} {north}, {west} {north}, {west} {south}))"
+        for south, west, north, east in get_square_bounds(data).tolist()
+    ])
+    return export
+
+DISK_CACHE_TTL = 600
+
+@st.cache_data(ttl=600, max_entries=48, show_spinner='Fetching data...')
 def fetch_data(start_hour, end_hour):
     query = """
     WITH hotspots AS (
@@ -58,36 +95,22 @@ def fetch_data(start_hour, end_hour):
         date,
         part_of_day as hr,
         day_of_week,
-        SAFE_CAST(delivery_count AS FLOAT64) as predicted_demand,
+        predicted_demand,
         hotspot_location,
-        ST_GEOGFROMTEXT(
-          CONCAT(
-            'POLYGON((',
-            ST_X(hotspot_location) - (buffer_size / (COS(ST_Y(hotspot_location) * ACOS(-1) / 180) * 111320)), ' ',
-            ST_Y(hotspot_location) - (buffer_size / 111320), ', ',
-            ST_X(hotspot_location) + (buffer_size / (COS(ST_Y(hotspot_location) * ACOS(-1) / 180) * 111320)), ' ',
-            ST_Y(hotspot_location) - (buffer_size / 111320), ', ',
-            ST_X(hotspot_location) + (buffer_size / (COS(ST_Y(hotspot_location) * ACOS(-1) / 180) * 111320)), ' ',
-            ST_Y(hotspot_location) + (buffer_size / 111320), ', ',
-            ST_X(hotspot_location) - (buffer_size / (COS(ST_Y(hotspot_location) * ACOS(-1) / 180) * 111320)), ' ',
-            ST_Y(hotspot_location) + (buffer_size / 111320), ', ',
-            ST_X(hotspot_location) - (buffer_size / (COS(ST_Y(hotspot_location) * ACOS(-1) / 180) * 111320)), ' ',
-            ST_Y(hotspot_location) - (buffer_size / 111320),
-            '))'
-          )
-        ) AS square_geometry
-      FROM `serve-robotics.serve_analytics.stg_delivery_platform__hotspots`,
-      UNNEST([325]) AS buffer_size
+        longitude,
+        latitude
+      FROM `serve-robotics.serve_analytics.hotspots_mv`
       WHERE label != '74'
-      AND date = DATE(DATETIME(CURRENT_TIMESTAMP(), 'America/Los_Angeles'))
-      AND day_of_week = LOWER(FORMAT_DATE('%A', DATE(DATETIME(CURRENT_TIMESTAMP(), 'America/Los_Angeles'))))
+      AND date = @today
+      AND day_of_week = LOWER(FORMAT_DATE('%A', @today))
     ),
 
     ranked_hotspots AS (
       SELECT
         label,
         hotspot_location,
-        square_geometry,
+        longitude,
+        latitude,
         hr,
         hotspots.predicted_demand
       FROM hotspots
@@ -96,9 +119,8 @@ def fetch_data(start_hour, end_hour):
     SELECT
       label,
       hr,
-      ST_ASTEXT(square_geometry) as square_geometry,
-      ST_X(hotspot_location) as longitude,
-      ST_Y(hotspot_location) as latitude,
+      h.longitude,
+      h.latitude,
       ROUND(CASE WHEN predicted_demand > 0 THEN predicted_demand ELSE 0 END, 1) as uber_eligible_offers
     FROM ranked_hotspots h
     LEFT JOIN `serve-robotics.serve_analytics.neighborhoods` n 
@@ -109,51 +131,103 @@ def fetch_data(start_hour, end_hour):
     """
     
     try:
+        # Today's date is a parameter rather than CURRENT_TIMESTAMP() so BigQuery can reuse cached results
+        today = datetime.now(pytz.timezone('America/Los_Angeles')).date()
         job_config = bigquery.QueryJobConfig(
             query_parameters=[
                 bigquery.ScalarQueryParameter("start_hour", "INTEGER", start_hour),
                 bigquery.ScalarQueryParameter("end_hour", "INTEGER", end_hour),
-            ]
+                bigquery.ScalarQueryParameter("today", "DATE", today),
+            ],
+            use_query_cache=True
         )
         
-        with st.spinner('Fetching data...'):
-            data = bq.query(query, job_config=job_config).result().to_dataframe()
+        cache_path = get_disk_cache_path(query, job_config.query_parameters)
+        data, _ = read_disk_cache(cache_path, DISK_CACHE_TTL)
+        if data is not None:
+            return data
+        
+        data = bq.query(query, job_config=job_config).result().to_dataframe(
+            bqstorage_client=get_bqstorage_client(),
+            create_bqstorage_client=False,
+            dtypes={'uber_eligible_offers': 'float32'}
+        )
+        write_disk_cache(cache_path, data)
         return data
     except Exception as e:
         st.error(f"Error fetching data: {str(e)}")
         return None
 
-def get_color(demand):
-    if demand <= 0.25:
-        return '#00CC00'    # Bright green
-    elif demand <= 0.5:
-        return '#66CC00'    # Light green
-    elif demand <= 0.75:
-        return '#FFFF00'    # Yellow
-    elif demand <= 1.0:
-        return '#FF9933'    # Orange
-    elif demand <= 2.0:
-        return '#FF6666'    # Light red
-    else:
-        return '#FF0000'    # Bright red
+@st.cache_data(ttl=600, max_entries=48, show_spinner=False)
+def fetch_hour_groups(start_hour, end_hour):
+    # Split the range once so each map hour is a dict lookup, not a column scan
+    data = fetch_data(start_hour, end_hour)
+    if data is None:
+        return {}
+    return {hr: group.reset_index(drop=True) for hr, group in data.groupby('hr', sort=False)}
 
-def create_map(data, hour=None, use_clustering=False):
-    if data is None or data.empty:
-        st.error("No data available for the selected time range.")
-        return None
-    
-    # Filter for specific hour if provided
-    if hour is not None:
-        data = data[data['hr'] == hour]
-    
-    # Create color scale
-    colormap = cm.LinearColormap(
-        colors=['#00CC00', '#66CC00', '#FFFF00', '#FF9933', '#FF6666', '#FF0000'],
+OFFER_PALETTE = np.array(['#00CC00', '#66CC00', '#FFFF00', '#FF9933', '#FF6666', '#FF0000'])
+
+# Above this many hotspots the map is drawn with pydeck (WebGL) instead of folium
+PYDECK_THRESHOLD = 500
+
+def get_offer_colors(data):
+    # Bucket offers into the palette: <=0.25, <=0.5, <=0.75, <=1, <=2, >2
+    return OFFER_PALETTE[np.digitize(data['uber_eligible_offers'].to_numpy(), [0.25, 0.5, 0.75, 1.0, 2.0], right=True)]
+
+def get_offer_colormap():
+    return cm.LinearColormap(
+        colors=OFFER_PALETTE.tolist(),
         vmin=0,
         vmax=2.5,
         caption='Eligible Offers',
         index=[0, 0.25, 0.5, 0.75, 1, 2]
     )
+
+def format_hotspot_fields(data):
+    # Display strings for every hotspot, formatted column-wise
+    labels = data['label'].astype(str)
+    hours = data['hr'].astype(str) + ":00"
+    offers = data['uber_eligible_offers'].map('{:.2f}'.format)
+    return labels, hours, offers
+
+def create_deck(data):
+    bounds = get_square_bounds(data)
+    labels, hours, offers = format_hotspot_fields(data)
+    polygons = pd.DataFrame({
+        'coordinates': [[[west, south], [east, south], [east, north], [west, north]] for south, west, north, east in bounds.tolist()],
+        'fillColor': [[int(color[i:i + 2], 16) for i in (1, 3, 5)] + [204] for color in get_offer_colors(data)],
+        'label': labels.to_numpy(),
+        'hr': hours.to_numpy(),
+        'offers': offers.to_numpy()
+    })
+    layer = pdk.Layer(
+        "PolygonLayer",
+        data=polygons,
+        get_polygon="coordinates",
+        get_fill_color="fillColor",
+        get_line_color=[0, 0, 0],
+        line_width_min_pixels=1,
+        stroked=True,
+        pickable=True
+    )
+    return pdk.Deck(
+        map_style='light',
+        initial_view_state=pdk.ViewState(latitude=34.0522, longitude=-118.2437, zoom=11),
+        layers=[layer],
+        tooltip={"html": "Label: {label}<br>Hour: {hr}<br>Eligible Offers: {offers}"}
+    )
+
+def create_map(data, use_clustering=False):
+    if data is None:
+        st.error("No data available for the selected time range.")
+        return None
+    
+    colors = get_offer_colors(data)
+    labels, hours, offers = format_hotspot_fields(data)
+    
+    # Create color scale
+    colormap = get_offer_colormap()
     
     # Create base map centered on LA
     m = folium.Map(
@@ -172,47 +246,70 @@ def create_map(data, hour=None, use_clustering=False):
         )
         
         # Add markers to cluster
-        for idx, row in data.iterrows():
-            color = get_color(row['uber_eligible_offers'])
-            
+        popups = (
+            "<div style='width: 150px'><b>Hotspot " + labels + "</b><br>"
+            + "Hour: " + hours + "<br>"
+            + "Eligible Offers: " + offers + "</div>"
+        )
+        for lat, lon, color, popup in zip(
+            data['latitude'].to_numpy(),
+            data['longitude'].to_numpy(),
+            colors,
+            popups.to_numpy()
+        ):
             # Create a circular marker for the cluster view
             folium.CircleMarker(
-                location=[row['latitude'], row['longitude']],
+                location=[lat, lon],
                 radius=20,
                 color='black',
                 weight=1,
                 fillColor=color,
                 fillOpacity=0.8,
-                popup=f"""
-                <div style='width: 150px'>
-                    <b>Hotspot {row['label']}</b><br>
-                    Hour: {row['hr']}:00<br>
-                    Eligible Offers: {row['uber_eligible_offers']:.2f}
-                </div>
-                """
+                popup=popup
             ).add_to(marker_cluster)
         
         marker_cluster.add_to(m)
         
     else:
-        # Add individual hotspot polygons (original visualization)
-        for idx, row in data.iterrows():
-            color = get_color(row['uber_eligible_offers'])
-            
-            try:
-                coordinates = parse_wkt_polygon(row['square_geometry'])
-                
-                folium.Polygon(
-                    locations=coordinates,
-                    color='black',
-                    weight=1,
-                    fillColor=color,
-                    fillOpacity=0.8,
-                    tooltip=f"Label: {row['label']}<br>Hour: {row['hr']}:00<br>Eligible Offers: {row['uber_eligible_offers']:.2f}"
-                ).add_to(m)
-            except Exception as e:
-                st.warning(f"Error plotting hotspot {row['label']}: {str(e)}")
-                continue
+        # Add hotspot squares as a single GeoJSON layer
+        bounds = get_square_bounds(data)
+        features = [
+            {
+                'type': 'Feature',
+                'properties': {
+                    'label': label,
+                    'hr': hr,
+                    'offers': offer,
+                    'color': str(color)
+                },
+                'geometry': {
+                    'type': 'Polygon',
+                    'coordinates': [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+                }
+            }
+            for label, hr, offer, (south, west, north, east), color in zip(
+                labels.to_numpy(),
+                hours.to_numpy(),
+                offers.to_numpy(),
+                bounds.tolist(),
+                colors
+            )
+        ]
+        
+        if features:
+            folium.GeoJson(
+                {'type': 'FeatureCollection', 'features': features},
+                style_function=lambda feature: {
+                    'color': 'black',
+                    'weight': 1,
+                    'fillColor': feature['properties']['color'],
+                    'fillOpacity': 0.8
+                },
+                tooltip=folium.GeoJsonTooltip(
+                    fields=['label', 'hr', 'offers'],
+                    aliases=['Label', 'Hour', 'Eligible Offers']
+                )
+            ).add_to(m)
     
     # Add color scale
     colormap.add_to(m)
@@ -251,7 +348,7 @@ def main():
         st.write(f"Showing Data for: {current_time.strftime('%Y-%m-%d')} {start_hour}:00 - {end_hour}:00")
         
         # Add export button
-        st.markdown(download_link(data, 
+        st.markdown(download_link(get_export_data(data), 
                                 f"hotspot_data_{start_hour}-{end_hour}.csv", 
                                 "📥 Download Data as CSV"), 
                    unsafe_allow_html=True)
@@ -280,14 +377,17 @@ def main():
                                       help="Group nearby hotspots when zoomed out")
         
         # Create and display map for selected hour
-        m = create_map(data, selected_hour, use_clustering)
-        if m is not None:
-            st_folium(m, width=1400, height=600)
+        hour_groups = fetch_hour_groups(start_hour, end_hour)
+        # An hour with no hotspots in the range gets an empty map, not an error
+        hour_data = hour_groups.get(selected_hour, data.iloc[0:0])
+        if len(hour_data) > PYDECK_THRESHOLD and not use_clustering:
+            # Same legend and height as the folium map below
+            st.markdown(get_offer_colormap()._repr_html_(), unsafe_allow_html=True)
+            st.pydeck_chart(create_deck(hour_data), height=600)
+        else:
+            m = create_map(hour_data, use_clustering)
+            if m is not None:
+                components.html(m.get_root().render(), width=1400, height=600)
 
 if __name__ == "__main__":
-    try:
-        bq = get_bq_client()
-        main()
-    except Exception as e:
-        st.error("Failed to initialize application. Please check your credentials.")
-        st.stop()
+    main()
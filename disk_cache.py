@@ -0,0 +1,57 @@
+import hashlib
+import os
+import tempfile
+import time
+
+import pandas as pd
+
+# Query results are also kept on disk, behind st.cache_data, so a Streamlit restart
+# doesn't re-run BigQuery. The cache is best effort: any disk error is treated as a miss.
+DISK_CACHE_DIR = os.path.join(tempfile.gettempdir(), 'maps_cache')
+DISK_CACHE_MAX_BYTES = 50 * 1024 * 1024
+# Files older than this are deleted on write. Kept well above every app's read TTL,
+# so a file one app still treats as fresh is never pruned by another app's write
+DISK_CACHE_MAX_AGE = 4 * 3600  # seconds
+
+def get_disk_cache_path(*key_parts):
+    key = hashlib.blake2b(repr(key_parts).encode()).hexdigest()
+    return os.path.join(DISK_CACHE_DIR, f"{key}.parquet")
+
+# Returns (data, mtime) for a file written less than ttl seconds ago, else (None, None)
+def read_disk_cache(cache_path, ttl):
+    try:
+        mtime = os.path.getmtime(cache_path)
+        if time.time() - mtime < ttl:
+            return pd.read_parquet(cache_path), mtime
+    except (OSError, ValueError):
+        pass
+    return None, None
+
+def prune_disk_cache():
+    now = time.time()
+    try:
+        with os.scandir(DISK_CACHE_DIR) as entries:
+            for entry in entries:
+                try:
+                    if now - entry.stat().st_mtime > DISK_CACHE_MAX_AGE:
+                        os.remove(entry.path)
+                except OSError:
+                    pass
+    except OSError:
+        pass
+
+def write_disk_cache(cache_path, data):
+    # Skip oversized results; write to a temp file first so readers never see a partial file
+    if data.memory_usage(deep=True).sum() > DISK_CACHE_MAX_BYTES:
+        return
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    try:
+        os.makedirs(DISK_CACHE_DIR, exist_ok=True)
+        prune_disk_cache()
+        data.to_parquet(tmp_path, index=False)
+        os.replace(tmp_path, cache_path)
+    except (OSError, ValueError):
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
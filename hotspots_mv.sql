@@ -0,0 +1,25 @@
+-- Hotspot predictions shared by aa.py, demand.py and updated.py.
+-- All three apps read from this view, so their queries fail until it has been created.
+-- Coordinates are extracted once per refresh instead of once per dashboard query.
+-- The view keeps every date, so it is partitioned by date like the base table:
+-- the apps' date filter prunes to one day and part_of_day clustering narrows it to the hour.
+CREATE MATERIALIZED VIEW IF NOT EXISTS `serve-robotics.serve_analytics.hotspots_mv`
+PARTITION BY date
+CLUSTER BY part_of_day, label
+OPTIONS (
+  enable_refresh = true,
+  refresh_interval_minutes = 60,
+  max_staleness = INTERVAL "1" HOUR,
+  allow_non_incremental_definition = true
+)
+AS
+SELECT
+  label,
+  date,
+  day_of_week,
+  part_of_day,
+  hotspot_location,
+  ST_X(hotspot_location) AS longitude,
+  ST_Y(hotspot_location) AS latitude,
+  SAFE_CAST(delivery_count AS FLOAT64) AS predicted_demand
+FROM `serve-robotics.serve_analytics.stg_delivery_platform__hotspots`;
@@ -1,33 +1,48 @@
 import streamlit as st
 import folium
-from streamlit_folium import st_folium
+import streamlit.components.v1 as components
 from google.cloud import bigquery
+from google.cloud import bigquery_storage
 import google.oauth2.credentials
 from datetime import datetime, timedelta
 import pytz
 from math import sqrt
 import pandas as pd
+import numpy as np
+from disk_cache import get_disk_cache_path, read_disk_cache, write_disk_cache
 
 # Page config
 st.set_page_config(page_title="Supply-Demand Distribution", layout="wide")
 
-# Initialize BigQuery client
+# Initialize BigQuery clients
+@st.cache_resource
+def get_credentials():
+    credentials_dict = st.secrets["gcp_service_account"]
+    return google.oauth2.credentials.Credentials(
+        None,
+        refresh_token=credentials_dict['refresh_token'],
+        token_uri="https://oauth2.googleapis.com/token",
+        client_id=credentials_dict['client_id'],
+        client_secret=credentials_dict['client_secret']
+    )
+
 @st.cache_resource
 def get_bq_client():
     try:
-        credentials_dict = st.secrets["gcp_service_account"]
-        credentials = google.oauth2.credentials.Credentials(
-            None,
-            refresh_token=credentials_dict['refresh_token'],
-            token_uri="https://oauth2.googleapis.com/token",
-            client_id=credentials_dict['client_id'],
-            client_secret=credentials_dict['client_secret']
-        )
-        return bigquery.Client(project='postmates-x', credentials=credentials)
+        return bigquery.Client(project='postmates-x', credentials=get_credentials())
     except Exception as e:
         st.error(f"Error initializing BigQuery client: {str(e)}")
         raise
 
+# Used by to_dataframe to download larger results as Arrow streams
+@st.cache_resource
+def get_bqstorage_client():
+    try:
+        return bigquery_storage.BigQueryReadClient(credentials=get_credentials())
+    except Exception as e:
+        st.error(f"Error initializing BigQuery Storage client: {str(e)}")
+        raise
+
 bq = get_bq_client()
 
 # Function to calculate square bounds
@@ -39,6 +54,8 @@ def get_square_bounds(lat, lon, side_length_meters):
         [lat + degree_delta, lon + degree_delta]
     ]
 
+DISK_CACHE_TTL = 3600
+
 @st.cache_data(ttl=3600)  # Cache for 1 hour
 def fetch_data(hour, day_offset):
     # Calculate the date based on the offset
@@ -46,36 +63,48 @@ def fetch_data(hour, day_offset):
     current_time = datetime.now(pst)
     refresh_time = current_time.strftime('%Y-%m-%d %H:%M:%S %Z')
     selected_date = current_time.date() + timedelta(days=day_offset)
+    # Half-open [hour_start, hour_end) window in local wall-clock time
+    hour_start = datetime.combine(selected_date, datetime.min.time().replace(hour=hour))
+    hour_end = hour_start + timedelta(hours=1)
+    prev_hour_start = hour_start - timedelta(hours=1)
     
-    query = f"""
-    DECLARE hour INT64 DEFAULT {hour};
-    DECLARE selected_date DATE DEFAULT DATE '{selected_date}';
-    CREATE TEMP FUNCTION get_part_of_day(hour INT64) AS (hour);
-
+    query = """
     WITH hotspots AS (
       SELECT
         label,
         hotspot_location,
-        ST_X(hotspot_location) as longitude,
-        ST_Y(hotspot_location) as latitude,
-        SAFE_CAST(delivery_count AS FLOAT64) as predicted_demand
-      FROM `serve-robotics.serve_analytics.stg_delivery_platform__hotspots`
-      WHERE date = selected_date
-      AND day_of_week = LOWER(FORMAT_DATE("%A", selected_date))
-      AND part_of_day = get_part_of_day(hour)
+        longitude,
+        latitude,
+        predicted_demand
+      FROM `serve-robotics.serve_analytics.hotspots_mv`
+      WHERE date = @selected_date
+      AND day_of_week = LOWER(FORMAT_DATE("%A", @selected_date))
+      AND part_of_day = @hour
+    ),
+
+    -- Previous hour's prediction per hotspot, for the trend arrow
+    prev_hotspots AS (
+      SELECT
+        label,
+        ANY_VALUE(predicted_demand) AS predicted_demand
+      FROM `serve-robotics.serve_analytics.hotspots_mv`
+      WHERE date = @prev_date
+      AND day_of_week = LOWER(FORMAT_DATE("%A", @prev_date))
+      AND part_of_day = @prev_hour
+      GROUP BY label
     ),
 
     hotspot_offers AS (
       SELECT
         h.label AS hotspot_label,
-        COUNT(DISTINCT q.partner_job_id) AS num_offers
+        APPROX_COUNT_DISTINCT(q.partner_job_id) AS num_offers
       FROM hotspots h
       LEFT JOIN `serve-robotics.serve_analytics.quotes` q
-        ON ST_DISTANCE(h.hotspot_location, q.pickup_location) <= 400
+        ON ST_DWITHIN(h.hotspot_location, q.pickup_location, 400)
       WHERE q.cardio_env = 'prod'
       AND q.partner_id = 'uber_eats_api'
-      AND TIMESTAMP(q.time) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
-      AND EXTRACT(HOUR FROM q.time AT TIME ZONE "America/Los_Angeles") = hour
+      AND q.time >= TIMESTAMP(@hour_start, "America/Los_Angeles")
+      AND q.time < TIMESTAMP(@hour_end, "America/Los_Angeles")
       AND q.partner_job_id IS NOT NULL
       GROUP BY h.label
     ),
@@ -89,7 +118,8 @@ def fetch_data(hour, day_offset):
         FROM `serve-robotics.serve_analytics.deliveries_wide`
         WHERE cardio_env = 'prod'
         AND partner_id = 'uber_eats_api'
-        AND TIMESTAMP(courier_dispatched_datetime_pst) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
+        AND TIMESTAMP(courier_dispatched_datetime_pst) >= TIMESTAMP(DATETIME_SUB(@hour_start, INTERVAL 1 DAY))
+        AND TIMESTAMP(courier_dispatched_datetime_pst) < TIMESTAMP(@hour_end)
       ),
 
       filtered_rover_state AS (
@@ -103,30 +133,29 @@ def fetch_data(hour, day_offset):
         LEFT JOIN delivery_times dt
           ON r.robot_id = dt.robot_id
           AND TIMESTAMP(r.time_pst) BETWEEN dt.start_ts AND dt.end_ts
-        WHERE EXTRACT(HOUR FROM r.time_pst) = hour
-          AND TIMESTAMP(r.time_pst) >= TIMESTAMP_SUB(CURRENT_TIMESTAMP(), INTERVAL 24 HOUR)
-          AND r.time > CURRENT_TIMESTAMP() - INTERVAL 2 DAY
+        WHERE TIMESTAMP(r.time_pst) >= TIMESTAMP(@hour_start)
+          AND TIMESTAMP(r.time_pst) < TIMESTAMP(@hour_end)
+          AND r.time >= TIMESTAMP(DATE_SUB(@selected_date, INTERVAL 1 DAY))
+          AND r.time < TIMESTAMP(DATE_ADD(@selected_date, INTERVAL 2 DAY))
           AND d.cardio_env = 'prod'
       ),
 
       point_assignments AS (
-        SELECT
+        SELECT DISTINCT
           r.robot_id,
           r.time_pst,
           r.is_on_delivery,
           TIMESTAMP_TRUNC(r.time_pst, HOUR) AS time_hour,
           h.label as location
         FROM filtered_rover_state r
-        CROSS JOIN hotspots h
-        WHERE ST_DISTANCE(h.hotspot_location, ST_GEOGPOINT(r.geo_pose_longitude, r.geo_pose_latitude)) <= 420
-        GROUP BY 1, 2, 3, 4, 5
+        JOIN hotspots h
+          ON ST_DWITHIN(h.hotspot_location, ST_GEOGPOINT(r.geo_pose_longitude, r.geo_pose_latitude), 420)
       ),
 
       bulk AS (
         SELECT
           *,
-          LEAD(time_pst) OVER (PARTITION BY robot_id ORDER BY time_pst) AS next_time_pst,
-          ROW_NUMBER() OVER (PARTITION BY robot_id, time_pst ORDER BY location) as rn
+          LEAD(time_pst) OVER (PARTITION BY robot_id ORDER BY time_pst) AS next_time_pst
         FROM point_assignments
       )
 
@@ -134,8 +163,7 @@ def fetch_data(hour, day_offset):
         location AS hotspot_label,
         is_on_delivery,
         robot_id,
-        SUM(TIMESTAMP_DIFF(next_time_pst, time_pst, SECOND) / 3600.0) AS hours,
-        COUNT(DISTINCT robot_id) AS num_robots
+        SUM(TIMESTAMP_DIFF(next_time_pst, time_pst, SECOND) / 3600.0) AS hours
       FROM bulk
       WHERE next_time_pst IS NOT NULL
       GROUP BY location, is_on_delivery, robot_id
@@ -144,14 +172,17 @@ def fetch_data(hour, day_offset):
     SELECT
       h.label AS hotspot_label,
       h.predicted_demand,
+      COALESCE(GREATEST(p.predicted_demand, 0), 0) AS prev_predicted_demand,
       h.latitude,
       h.longitude,
       COALESCE(ho.num_offers, 0) AS num_offers,
       COALESCE(SUM(CASE WHEN hs.is_on_delivery = FALSE THEN hs.hours END), 0) AS on_duty_not_on_delivery_hours,
       COALESCE(SUM(CASE WHEN hs.is_on_delivery = TRUE THEN hs.hours END), 0) AS on_duty_on_delivery_hours,
       COALESCE(SUM(hs.hours), 0) AS net_supply_hours,
-      COUNT(DISTINCT hs.robot_id) AS num_robots
+      APPROX_COUNT_DISTINCT(hs.robot_id) AS num_robots
     FROM hotspots h
+    LEFT JOIN prev_hotspots p
+      ON h.label = p.label
     LEFT JOIN hotspot_offers ho
       ON h.label = ho.hotspot_label
     LEFT JOIN hotspot_supply_hours hs
@@ -159,34 +190,44 @@ def fetch_data(hour, day_offset):
     GROUP BY
       h.label,
       h.predicted_demand,
+      p.predicted_demand,
       h.latitude,
       h.longitude,
       ho.num_offers
     ORDER BY h.predicted_demand DESC;
     """
     
+    job_config = bigquery.QueryJobConfig(
+        query_parameters=[
+            bigquery.ScalarQueryParameter("hour", "INTEGER", hour),
+            bigquery.ScalarQueryParameter("selected_date", "DATE", selected_date),
+            bigquery.ScalarQueryParameter("hour_start", "DATETIME", hour_start),
+            bigquery.ScalarQueryParameter("hour_end", "DATETIME", hour_end),
+            bigquery.ScalarQueryParameter("prev_hour", "INTEGER", prev_hour_start.hour),
+            bigquery.ScalarQueryParameter("prev_date", "DATE", prev_hour_start.date()),
+        ],
+        use_query_cache=True
+    )
+
+    cache_path = get_disk_cache_path(query, job_config.query_parameters)
+    data, cached_mtime = read_disk_cache(cache_path, DISK_CACHE_TTL)
+    if data is not None:
+        cached_time = datetime.fromtimestamp(cached_mtime, pst)
+        return data, cached_time.strftime('%Y-%m-%d %H:%M:%S %Z')
+
     with st.spinner('Fetching data...'):
-        data = bq.query(query).result().to_dataframe()
+        data = bq.query(query, job_config=job_config).result().to_dataframe(
+            bqstorage_client=get_bqstorage_client(),
+            create_bqstorage_client=False
+        )
         data.loc[data['predicted_demand'] <= 0, 'predicted_demand'] = 0
+    write_disk_cache(cache_path, data)
     return data, refresh_time
 
-@st.cache_data(ttl=3600)  # Cache for 1 hour
-def fetch_previous_hour_data(hour, day_offset):
-    prev_hour = hour - 1
-    prev_day_offset = day_offset
-    
-    if prev_hour < 0:
-        prev_hour = 23
-        prev_day_offset -= 1
-        
-    prev_data, _ = fetch_data(prev_hour, prev_day_offset)
-    return prev_data
-
 @st.cache_data(ttl=3600)  # Cache for 1 hour
 def create_map(hour, day_offset):
     # Get data using cached function
     data, refresh_time = fetch_data(hour, day_offset)
-    prev_data = fetch_previous_hour_data(hour, day_offset)
     
     # Check if data is empty or contains all NaN values
     if data.empty or data['latitude'].isna().all() or data['longitude'].isna().all():
@@ -205,82 +246,96 @@ def create_map(hour, day_offset):
         'No Activity': '#888888'                 # Gray (all other cases)
     }
 
-    # Updated status function with new criteria
-    def get_status(row):
-        demand = row['predicted_demand']
-        supply = row['net_supply_hours']
-        
-        # Dark Green - Strong demand fully met
-        if demand >= 5 and supply >= demand:
-            return 'Strong Demand With Supply'
-        
-        # Green - Moderate to high demand fully met
-        elif 1 < demand < 5 and supply >= demand:
-            return 'Demand With Supply'
-        
-        # Orange - High demand with some but insufficient supply
-        elif demand > 1 and supply > 0 and supply < demand:
-            return 'Demand With Insufficient Supply'
-        
-        # Yellow - Weak demand with adequate supply
-        elif 0.1 < demand <= 1 and supply > 0.5:
-            return 'Weak Demand With Supply'
-        
-        # Bold Red - High demand with no supply
-        elif demand >= 1 and supply == 0:
-            return 'High Demand No Supply'
-            
-        # Light Red - Low to moderate demand with no supply
-        elif 0.1 < demand < 1 and supply == 0:
-            return 'Low Demand No Supply'
-        
-        # Blue - No demand but supply exists
-        elif demand <= 0.1 and supply > 0.2:
-            return 'Supply No Demand'
-        
-        # Gray - No significant activity
-        else:
-            return 'No Activity'
-    
-    data['status'] = data.apply(get_status, axis=1)
+    # Status criteria, evaluated over whole columns; first matching condition wins
+    demand = data['predicted_demand'].to_numpy()
+    supply = data['net_supply_hours'].to_numpy()
+    conditions = [
+        (demand >= 5) & (supply >= demand),                  # Dark Green - Strong demand fully met
+        (demand > 1) & (demand < 5) & (supply >= demand),    # Green - Moderate to high demand fully met
+        (demand > 1) & (supply > 0) & (supply < demand),     # Orange - High demand with some but insufficient supply
+        (demand > 0.1) & (demand <= 1) & (supply > 0.5),     # Yellow - Weak demand with adequate supply
+        (demand >= 1) & (supply == 0),                       # Bold Red - High demand with no supply
+        (demand > 0.1) & (demand < 1) & (supply == 0),       # Light Red - Low to moderate demand with no supply
+        (demand <= 0.1) & (supply > 0.2)                     # Blue - No demand but supply exists
+    ]
+    choices = [
+        'Strong Demand With Supply',
+        'Demand With Supply',
+        'Demand With Insufficient Supply',
+        'Weak Demand With Supply',
+        'High Demand No Supply',
+        'Low Demand No Supply',
+        'Supply No Demand'
+    ]
+    # Gray - No significant activity
+    data['status'] = np.select(conditions, choices, default='No Activity')
+
+    # Fill color by integer category code; categories follow color_scheme's order
+    status_codes = pd.Categorical(data['status'], categories=list(color_scheme)).codes
+    data['fillColor'] = np.array(list(color_scheme.values()))[status_codes]
 
     m = folium.Map(location=[34.0522, -118.2437],  # LA coordinates
               zoom_start=13,
               tiles='cartodbpositron')
 
-    # Add hotspot squares with trend indicators
-    for idx, row in data.iterrows():
-        if pd.notna(row['hotspot_label']):
-            # Get previous hour demand for this hotspot
-            prev_demand = prev_data[prev_data['hotspot_label'] == row['hotspot_label']]['predicted_demand'].iloc[0] if len(prev_data[prev_data['hotspot_label'] == row['hotspot_label']]) > 0 else 0
-            
-            # Calculate trend
-            trend = "→"
-            if row['predicted_demand'] > prev_demand:
-                trend = "↑"
-            elif row['predicted_demand'] < prev_demand:
-                trend = "↓"
-                
-            bounds = get_square_bounds(row['latitude'], row['longitude'], 400)
-            popup_content = f"""
-            <b>Hotspot {row['hotspot_label']}</b><br>
-            Predicted Demand: {row['predicted_demand']:.2f} {trend}<br>
-            Previous Hour: {prev_demand:.2f}<br>
-            Actual Offers: {row['num_offers']}<br>
-            Supply Hours: {row['net_supply_hours']:.2f}<br>
-            Status: {row['status']}
-            """
-            folium.Rectangle(
-                bounds=bounds,
-                color='black',
-                weight=1,
-                fill=True,
-                fillColor=color_scheme[row['status']],
-                fillOpacity=0.6,
-                popup=popup_content
-            ).add_to(m)
+    # Trend against the previous hour's demand, which the query returns alongside
+    data['trend'] = np.where(
+        data['predicted_demand'] > data['prev_predicted_demand'], "↑",
+        np.where(data['predicted_demand'] < data['prev_predicted_demand'], "↓", "→")
+    )
+
+    # Popup HTML for every hotspot, formatted column-wise
+    data['popup_html'] = (
+        "<b>Hotspot " + data['hotspot_label'].astype(str) + "</b><br>"
+        + "Predicted Demand: " + data['predicted_demand'].map('{:.2f}'.format) + " " + data['trend'] + "<br>"
+        + "Previous Hour: " + data['prev_predicted_demand'].map('{:.2f}'.format) + "<br>"
+        + "Actual Offers: " + data['num_offers'].astype(str) + "<br>"
+        + "Supply Hours: " + data['net_supply_hours'].map('{:.2f}'.format) + "<br>"
+        + "Status: " + data['status']
+    )
+
+    # Add hotspot squares with trend indicators as a single GeoJSON layer
+    hotspots = data.dropna(subset=['hotspot_label'])
+    (south, west), (north, east) = get_square_bounds(
+        hotspots['latitude'].to_numpy(dtype='float64'),
+        hotspots['longitude'].to_numpy(dtype='float64'),
+        400
+    )
+    features = []
+    for s_lat, w_lon, n_lat, e_lon, fill_color, popup_content in zip(
+        south.tolist(),
+        west.tolist(),
+        north.tolist(),
+        east.tolist(),
+        hotspots['fillColor'].to_numpy(),
+        hotspots['popup_html'].to_numpy()
+    ):
+        features.append({
+            'type': 'Feature',
+            'properties': {
+                'fillColor': str(fill_color),
+                'popup': popup_content
+            },
+            'geometry': {
+                'type': 'Polygon',
+                'coordinates': [[[w_lon, s_lat], [e_lon, s_lat], [e_lon, n_lat], [w_lon, n_lat], [w_lon, s_lat]]]
+            }
+        })
+
+    if features:
+        folium.GeoJson(
+            {'type': 'FeatureCollection', 'features': features},
+            style_function=lambda feature: {
+                'color': 'black',
+                'weight': 1,
+                'fillColor': feature['properties']['fillColor'],
+                'fillOpacity': 0.6
+            },
+            popup=folium.GeoJsonPopup(fields=['popup'], labels=False)
+        ).add_to(m)
 
-    return m, color_scheme, refresh_time
+    # Cache the rendered HTML rather than the Map object so reruns skip serialization
+    return m.get_root().render(), color_scheme, refresh_time
 
 def main():
     st.title("Supply-Demand Distribution")
@@ -328,9 +383,9 @@ def main():
     st.write(f"Showing Data for: {display_time.strftime('%Y-%m-%d %H:00')} - {(display_time + timedelta(hours=1)).strftime('%H:00')}")
     
     # Create and display map
-    m, color_scheme, refresh_time = create_map(hour, day_offset)
-    if m is not None and color_scheme is not None:
-        st_folium(m, width=1400, height=600)
+    map_html, color_scheme, refresh_time = create_map(hour, day_offset)
+    if map_html is not None and color_scheme is not None:
+        components.html(map_html, width=1400, height=600)
         
         # Display refresh time
         st.markdown(f"""